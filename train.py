@@ -4,13 +4,13 @@ import time
 import numpy as np
 import torch
 from torch import nn
-from torch.utils.data import DataLoader
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
 from sklearn.metrics import confusion_matrix
 from model.siamunet_diff import SiamUnet_diff
-from utils import ChangeDetectionDataset, load_config
+from utils import ChangeDetectionDataset, gpu_normalize, load_config
 
 config = load_config()
 
@@ -38,8 +38,8 @@ def train(train_loader, n_epochs: int):
         print('Epoch: ' + str(epoch_index + 1) + ' of ' + str(n_epochs))
 
         for batch in train_loader:
-            I1 = batch['I1'].float().cuda()
-            I2 = batch['I2'].float().cuda()
+            I1 = gpu_normalize(batch['I1'])
+            I2 = gpu_normalize(batch['I2'])
             label = batch['label'].cuda()
             optimizer.zero_grad()
             output = net(I1, I2)
@@ -77,7 +77,9 @@ writer = SummaryWriter()
 train_dataset = ChangeDetectionDataset(config, transform=None)
 weights = torch.FloatTensor(train_dataset.weights).cuda()
 loss_fn = nn.NLLLoss(weight=weights)
-train_loader = DataLoader(train_dataset, batch_size=config['model-param']['batch_size'], shuffle=True, num_workers=8)
+# whole batches of indices are passed to the dataset, which gathers them with a single tensor indexing
+batch_sampler = BatchSampler(RandomSampler(train_dataset), config['model-param']['batch_size'], drop_last=False)
+train_loader = DataLoader(train_dataset, batch_size=None, sampler=batch_sampler, num_workers=8, pin_memory=True)
 
 t_start = time.time()
 train(train_loader, config['model-param']['n_epochs'])
@@ -1,41 +1,128 @@
 # PyTorch
 
+import functools
+import hashlib
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import TypedDict
 
 import natsort
 import numpy as np
+import tifffile
 import torch
 import yaml
 from PIL import Image
 from nptyping import NDArray, Int
 from numpy import ndarray
-from numpy.lib.stride_tricks import as_strided
-from skimage import io
 from torch.utils.data import Dataset
 from tqdm import tqdm
 
-
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    # PyYAML built without libyaml
+    from yaml import SafeLoader
+
+try:
+    import rasterio
+    from rasterio.windows import Window
+except ImportError:
+    # rasterio is optional, read_patches falls back to reading the whole TIFF
+    rasterio = None
+
+try:
+    import cv2
+except ImportError:
+    # opencv is optional, read_label falls back to PIL for RGB labels
+    cv2 = None
+
+try:
+    from utils_numba import rgb_to_idx
+except ImportError:
+    # numba is optional, rgb_to_indices falls back to numpy bitwise operations
+    rgb_to_idx = None
+
+# RGB colour of each class label, indexed by class id
+PALETTE = np.array([[0, 0, 0],
+                    [128, 0, 0],
+                    [0, 128, 0],
+                    [128, 128, 0],
+                    [0, 0, 128],
+                    [128, 0, 128],
+                    [0, 128, 128],
+                    [128, 128, 128]], dtype=np.uint8)
+# Patches are stored unnormalized, the uint16 Planet L3H-SR reflectances are kept bit for bit in int16 since torch
+# has no uint16 tensors
+RAW_DTYPE = np.int16
+# Bumped whenever the content of the patch cache changes, older caches are then rebuilt
+CACHE_VERSION = 2
+
+
+@functools.lru_cache(maxsize=None)
 def load_config(configfile: str = 'config.yml') -> TypedDict:
     """
-    Load configuration variable from the configuration file
+    Load configuration variable from the configuration file, parsed once per file
     :param configfile: config file path
     :return: dict with all configurations
     """
     with open(configfile, 'r') as stream:
-        try:
-            config = yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-    return config
+        return yaml.load(stream, Loader=SafeLoader)
 
 
-def read_and_normalized_planet_images_from_cm(cm_label_path: str, planet_boxes_path: str):
+def read_tiff(image_path: str) -> ndarray:
     """
-    Read planet images from matching semi-supervised labels
+    Read a TIFF image, memory-mapped when its data is stored uncompressed and contiguous
+    :param image_path: TIFF file path
+    :return: numpy array (or copy-on-write numpy memmap) of shape (size_y, size_x, bands)
+    """
+    try:
+        # copy-on-write keeps the file untouched while letting torch.from_numpy wrap the buffer without a warning
+        return tifffile.memmap(image_path, mode='c')
+    except ValueError:
+        # compressed or tiled TIFF, the data has to be decoded
+        return tifffile.imread(image_path)
+
+
+def to_raw(image: ndarray) -> ndarray:
+    """
+    Reinterpret uint16 reflectances as RAW_DTYPE without copying nor scanning, gpu_normalize recovers the unsigned
+    values on the device
+    :param image: unsigned integer numpy array
+    :return: RAW_DTYPE view (a converted copy for other dtypes than uint16)
+    """
+    return image.astype(np.uint16, copy=False).view(RAW_DTYPE)
+
+
+def read_patches(image_path: str, new_size=(256, 256)) -> ndarray:
+    """
+    Read a TIFF image directly as raw patches, one windowed read per patch when rasterio is available
+    :param image_path: TIFF file path
+    :param new_size: tuple with patch_sizes in form (patch_size_y, patch_size_x)
+    :return: RAW_DTYPE numpy array of shape (#patches_y * #patches_x, bands, patch_size_y, patch_size_x)
+    """
+    if rasterio is None:
+        image = read_tiff(image_path)
+        return to_raw(cut_image_strided(image.transpose(2, 0, 1), new_size))
+
+    new_size_y, new_size_x = new_size
+    with rasterio.open(image_path) as src:
+        nr_images_y = src.height // new_size_y
+        nr_images_x = src.width // new_size_x
+        patches = np.empty((nr_images_y * nr_images_x, src.count, new_size_y, new_size_x), dtype=src.dtypes[0])
+        for num_patch in range(patches.shape[0]):
+            row_off = (num_patch // nr_images_x) * new_size_y
+            col_off = (num_patch % nr_images_x) * new_size_x
+            src.read(window=Window(col_off, row_off, new_size_x, new_size_y), out=patches[num_patch])
+    return to_raw(patches)
+
+
+def get_planet_images_paths_from_cm(cm_label_path: str, planet_boxes_path: str):
+    """
+    Find the planet images matching semi-supervised labels
     :param cm_label_path: semi-supervised labels file path
     :param planet_boxes_path: Planet images folder path
-    :return: normalized numpy arrray of original and changed image
+    :return: file paths of original and changed image
     """
     parallel_number = cm_label_path.split('_')[0]
     planet_east_west_folder_name = cm_label_path[4:-20]
@@ -45,60 +132,147 @@ def read_and_normalized_planet_images_from_cm(cm_label_path: str, planet_boxes_p
                                        'L3H-SR', original_image_name)
     changed_image_path = os.path.join(planet_boxes_path, parallel_number, planet_east_west_folder_name,
                                       'L3H-SR', changed_image_name)
-    I1, I2 = io.imread(original_image_path), io.imread(changed_image_path)
-    new_min = -1
-    new_max = 1
-    I1 = (I1 - np.min(I1)) / (np.max(I1) - np.min(I1)) * (new_max - new_min) + new_min
-    I2 = (I2 - np.min(I2)) / (np.max(I2) - np.min(I2)) * (new_max - new_min) + new_min
-    return I1, I2
+    return original_image_path, changed_image_path
+
+
+def read_planet_images_from_cm(cm_label_path: str, planet_boxes_path: str):
+    """
+    Read planet images from matching semi-supervised labels
+    :param cm_label_path: semi-supervised labels file path
+    :param planet_boxes_path: Planet images folder path
+    :return: raw numpy arrray of original and changed image patches
+    """
+    original_image_path, changed_image_path = get_planet_images_paths_from_cm(cm_label_path, planet_boxes_path)
+    return read_patches(original_image_path), read_patches(changed_image_path)
+
+
+def _files_fingerprint(file_paths) -> str:
+    """
+    Hash the paths, sizes and modification times of dataset files, to detect added, removed or replaced files
+    :param file_paths: iterable of file paths
+    :return: hexadecimal digest
+    """
+    digest = hashlib.sha1()
+    for file_path in sorted(set(file_paths)):
+        stat = os.stat(file_path)
+        digest.update('{}:{}:{}\n'.format(os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+def gpu_normalize(batch: torch.Tensor, device: str = 'cuda') -> torch.Tensor:
+    """
+    Move a batch of RAW_DTYPE patches to the device and standardize each patch band to zero mean and unit variance
+    :param batch: tensor of shape (batch_size, bands, size_y, size_x)
+    :param device: device on which the normalization runs
+    :return: float32 tensor on the device
+    """
+    # RAW_DTYPE holds uint16 bits, they are read back as unsigned values before the float conversion
+    x = (batch.to(device, non_blocking=True).to(torch.int32) & 0xFFFF).float()
+    mean = x.mean(dim=(-2, -1), keepdim=True)
+    std = x.std(dim=(-2, -1), keepdim=True).clamp_min(1e-6)
+    return (x - mean) / std
 
 
 def mask2rgb(mask: NDArray[Int]) -> ndarray:
     """
-    Convert numpy mask to rbg thanks to color_label_dict
+    Convert numpy mask to rbg thanks to the PALETTE lookup table
     :param mask: Numpy with labels value between 0 and 8
     :return: numpy array
     """
-    color_label_dict = {0: (0, 0, 0),
-                        1: (128, 0, 0),
-                        2: (0, 128, 0),
-                        3: (128, 128, 0),
-                        4: (0, 0, 128),
-                        5: (128, 0, 128),
-                        6: (0, 128, 128),
-                        7: (128, 128, 128)}
-
-    maskRGB = np.empty((mask.shape[1], mask.shape[2], 3))
     mask = np.squeeze(mask)
-    for key in color_label_dict.keys():
-        pixel_value = color_label_dict[key]
-        maskRGB[mask == key] = pixel_value
+    return PALETTE[mask]
+
 
-    return maskRGB.astype(np.uint8)
+def tile_on_gpu(image: ndarray, new_size=(256, 256), device: str = 'cuda') -> torch.Tensor:
+    """
+    Same tiling as cut_image_strided, done with unfold in device memory after a single host to device copy of the
+    image buffer as read, without any host side copy
+    :param image: 3 dimensional numpy array of shape (size_y, size_x, channels), as returned by read_tiff
+    :param new_size: tuple with patch_sizes in form (patch_size_y, patch_size_x)
+    :param device: device on which the tiling runs
+    :return: RAW_DTYPE tensor of shape (#patches_y * #patches_x, bands, patch_size_y, patch_size_x) on the device
+    """
+    new_size_y, new_size_x = new_size
+    t = torch.from_numpy(to_raw(image)).to(device, non_blocking=True)
+    # (#patches_y, #patches_x, bands, patch_size_y, patch_size_x)
+    t = t.unfold(0, new_size_y, new_size_y).unfold(1, new_size_x, new_size_x)
+    return t.reshape(-1, t.shape[2], new_size_y, new_size_x)
 
 
 def cut_image_strided(image, new_size):
     """
     Given a tuple with a new size (s1,s2)
-    Reorders an image of the size (b, y*s1, x*s2) into a new array (y,x,b,s1,s2) where b is the number of bands
+    Reorders an image of the size (b, y*s1, x*s2) into a new contiguous array (y*x,b,s1,s2) where b is the number
+    of bands
     Example: Image with 10 bands and shape (10, 500, 500) and new_size (100, 100) will be transformed into an array
-    of shape (5, 5, 10, 100, 100)
+    of shape (25, 10, 100, 100)
     :param image: 3 dimensional numpy array of shape (channels, size_y, size_x)
     :param new_size: tuple with patch_sizes in form (patch_size_y, patch_size_x)
-    :return: numpy array with 5 dimensions, shape (#patches_y, #patches_x, bands, patch_size_y, patch_size_x)
+    :return: numpy array with 4 dimensions, shape (#patches_y * #patches_x, bands, patch_size_y, patch_size_x)
     """
-    bands = image.shape[0]
+    bands, old_size_y, old_size_x = image.shape
     new_size_y, new_size_x = new_size
-    old_size_y = image.shape[1]
-    old_size_x = image.shape[2]
-    nr_images_x = old_size_x // new_size[1]
-    nr_images_y = old_size_y // new_size[0]
+    nr_images_x = old_size_x // new_size_x
+    nr_images_y = old_size_y // new_size_y
     if old_size_x % new_size_x != 0 or old_size_y % new_size_y != 0:
         print("The patch size is not a full multiple of the complete patch size")
 
-    return as_strided(image, shape=(nr_images_y, nr_images_x, bands, new_size_y, new_size_x),
-                      strides=(image.strides[1] * new_size_y, image.strides[2] * new_size_x, image.strides[0],
-                               image.strides[1], image.strides[2]))
+    image = image[:, :nr_images_y * new_size_y, :nr_images_x * new_size_x]
+    return np.ascontiguousarray(
+        image.reshape(bands, nr_images_y, new_size_y, nr_images_x, new_size_x).transpose(1, 3, 0, 2, 4)
+    ).reshape(nr_images_y * nr_images_x, bands, new_size_y, new_size_x)
+
+
+def rgb_to_indices(rgb_arr: ndarray) -> ndarray:
+    """
+    Convert rgb array to the multiclass mask
+    Every PALETTE colour is in {0, 128}^3 and its class id is the 3 bit number (b, g, r) of its channels high bits
+    :param rgb_arr: uint8 numpy array of shape (size_y, size_x, 3)
+    :return: uint8 numpy array of shape (size_y, size_x) with labels value between 0 and 7
+    """
+    if rgb_to_idx is not None:
+        indices = np.empty(rgb_arr.shape[:2], dtype=np.uint8)
+        rgb_to_idx(np.ascontiguousarray(rgb_arr, dtype=np.uint8), indices)
+        return indices
+    return ((rgb_arr[..., 2] >> 5) & 4) | ((rgb_arr[..., 1] >> 6) & 2) | (rgb_arr[..., 0] >> 7)
+
+
+def read_label(cm_label_path: str) -> ndarray:
+    """
+    Read a semi-supervised label as a multiclass mask, palette PNGs are mapped through their palette only
+    :param cm_label_path: semi-supervised label file path
+    :return: uint8 numpy array of shape (size_y, size_x) with labels value between 0 and 7
+    """
+    # Image.open only parses the header, the pixels are decoded by whichever branch is taken
+    with Image.open(cm_label_path) as label:
+        if label.mode == 'P':
+            # class id of each palette entry, then a single lookup per pixel
+            palette_indices = rgb_to_indices(np.asarray(label.getpalette(), dtype=np.uint8).reshape(-1, 1, 3))[:, 0]
+            return palette_indices[np.asarray(label)]
+        if cv2 is not None:
+            # single decode to a BGR array, reversed to RGB as a view
+            label_bgr = cv2.imread(cm_label_path, cv2.IMREAD_COLOR)
+            if label_bgr is not None:
+                return rgb_to_indices(label_bgr[:, :, ::-1])
+        # opencv is missing or could not decode the file (e.g. non ASCII path on Windows)
+        return rgb_to_indices(np.asarray(label.convert('RGB')))
+
+
+def _process_one(cm_label_path: str, cm_label_file_name: str, planet_boxes_path: str):
+    """
+    Load one semi-supervised label and its matching Planet images, run in a worker process
+    :param cm_label_path: semi-supervised label file path
+    :param cm_label_file_name: semi-supervised label file name
+    :param planet_boxes_path: Planet images folder path
+    :return: label patches, original image patches, changed image patches and per class pixel counts
+    """
+    I1_patches_reshape, I2_patches_reshape = read_planet_images_from_cm(cm_label_file_name, planet_boxes_path)
+
+    cm_indices_np = read_label(cm_label_path)
+    local_counts = np.zeros(len(PALETTE), dtype=np.int64)
+    ChangeDetectionDataset.compute_for_INS_weights(cm_indices_np, local_counts)
+    cm_reshape = cut_image_strided(cm_indices_np[np.newaxis], (256, 256))[:, 0]
+    return cm_reshape, I1_patches_reshape, I2_patches_reshape, local_counts
 
 
 # def get_matching_planet_path_image(one_location_cm_label_folder_name):
@@ -112,94 +286,152 @@ class ChangeDetectionDataset(Dataset):
 
     def __init__(self, config, transform=None, train=True):
         # basics
-        self.color_label_dict = {0: (0, 0, 0),
-                                 1: (128, 0, 0),
-                                 2: (0, 128, 0),
-                                 3: (128, 128, 0),
-                                 4: (0, 0, 128),
-                                 5: (128, 0, 128),
-                                 6: (0, 128, 128),
-                                 7: (128, 128, 128)}
-
         self.transform = transform
         self.label_path = config['dataset']['semi_supervised_labels_path']
         self.train = train
 
-        # load images
+        # load images, per image patch batches are concatenated once loading is done
         self.imgs_1 = []
         self.imgs_2 = []
         self.labels = []
         self.n_patches = 0
-        n_pix = 0
-        n_pix0 = 0
-        n_pix1 = 0
-        n_pix2 = 0
-        n_pix3 = 0
-        n_pix4 = 0
-        n_pix5 = 0
-        n_pix6 = 0
-        n_pix7 = 0
+        counts = np.zeros(len(PALETTE), dtype=np.int64)
+
+        # list the dataset files first, they are part of the cache key
+        if train:
+            cm_label_files = []
+            with os.scandir(self.label_path) as location_entries:
+                one_location_cm_label_paths = [entry.path for entry in location_entries if entry.is_dir()]
+            for one_location_cm_label_path in one_location_cm_label_paths:
+                with os.scandir(one_location_cm_label_path) as label_entries:
+                    cm_label_files.extend((entry.path, entry.name) for entry in label_entries
+                                          if entry.name.endswith('.png'))
+            planet_boxes_path = config['dataset']['planet_boxes_path']
+            source_files = [cm_label_path for cm_label_path, _ in cm_label_files]
+            for _, cm_label_file_name in cm_label_files:
+                source_files.extend(get_planet_images_paths_from_cm(cm_label_file_name, planet_boxes_path))
+        else:
+            # pairs of (original, changed) image paths, grouped by location
+            test_image_pairs = []
+            with os.scandir(config['dataset']['planet_test_boxes_path']) as lat_entries:
+                one_lat_test_paths = [entry.path for entry in lat_entries if entry.is_dir()]
+            for one_lat_test_path in one_lat_test_paths:
+                with os.scandir(one_lat_test_path) as location_entries:
+                    one_location_test_paths = [entry.path for entry in location_entries]
+                for one_location_test_path in one_location_test_paths:
+                    test_folder_path = os.path.join(one_location_test_path, 'L3H-SR')
+                    with os.scandir(test_folder_path) as test_entries:
+                        test_file_name_filtered = [entry.name for entry in test_entries if '-01.tif' in entry.name]
+                    test_file_name_filtered_and_sort = natsort.natsorted(test_file_name_filtered)
+                    test_image_pairs.append(
+                        [(os.path.join(test_folder_path, test_file_name),
+                          os.path.join(test_folder_path, test_file_name_filtered_and_sort[idx + 1]))
+                         for idx, test_file_name in enumerate(test_file_name_filtered_and_sort) if idx != 23])
+            source_files = [image_path for location_pairs in test_image_pairs
+                            for image_pair in location_pairs for image_path in image_pair]
+
+        # raw patches are reused from the cache folder when they were computed from the same dataset files
+        cache_dir = config['dataset'].get('cache_dir')
+        if cache_dir is not None:
+            cache_sources = {name: os.path.abspath(config['dataset'][name])
+                             for name in ('semi_supervised_labels_path', 'planet_boxes_path', 'planet_test_boxes_path')}
+            cache_sources['files'] = _files_fingerprint(source_files)
+            cache_dir = os.path.join(cache_dir, 'train' if train else 'test')
+            if self._load_cache(cache_dir, cache_sources):
+                return
 
         if train:
-            for one_location_cm_label_folder_name in tqdm(os.listdir(self.label_path)):
-                # load and store each image
-                one_location_cm_label_path = os.path.join(self.label_path, one_location_cm_label_folder_name)
-                for cm_label_file_name in os.listdir(one_location_cm_label_path):
-                    cm_label_path = os.path.join(one_location_cm_label_path, cm_label_file_name)
-
-                    I1, I2 = read_and_normalized_planet_images_from_cm(cm_label_file_name, config['dataset']['planet_boxes_path'])
-
-                    cm_rgb_np = np.asarray(Image.open(cm_label_path).convert('RGB'))
-                    cm_encoded = self.rgb_to_onehot(cm_rgb_np)
-                    cm_indices_np = np.argmax(cm_encoded, axis=2)
-                    n_pix0, n_pix1, n_pix2, n_pix3, n_pix4, n_pix5, n_pix6, n_pix7 = self.compute_for_INS_weights(
-                        cm_indices_np, n_pix, n_pix0, n_pix1, n_pix2, n_pix3, n_pix4, n_pix5, n_pix6, n_pix7)
-                    cm_reshape = cm_indices_np.reshape(16, 256, 256)
-                    for num_patch in range(0, cm_reshape.shape[0]):
-                        self.labels.append(torch.from_numpy(cm_reshape[num_patch]))
-
-                    I1_patches = cut_image_strided(I1.transpose(2, 0, 1), (256, 256))
-                    I1_patches_reshape = I1_patches.reshape(I1_patches.shape[0] * I1_patches.shape[1],
-                                                            *I1_patches.shape[2:])
-                    for num_patch in range(0, I1_patches_reshape.shape[0]):
-                        self.imgs_1.append(torch.from_numpy(I1_patches_reshape[num_patch]))
-
-                    I2_resized = cut_image_strided(I2.transpose(2, 0, 1), (256, 256))
-                    I2_patches_reshape = I2_resized.reshape(I2_resized.shape[0] * I2_resized.shape[1],
-                                                            *I2_resized.shape[2:])
-                    for num_patch in range(0, I2_patches_reshape.shape[0]):
-                        self.imgs_2.append(torch.from_numpy(I2_patches_reshape[num_patch]))
-            self.weights = [1 / n_pix0, 1 / n_pix1, 1 / n_pix2, 1 / n_pix3, 1 / n_pix4, 1 / n_pix5, 1 / n_pix6,
-                            1 / n_pix7]
+            # load and store each image, each label / Planet images pair is decoded in its own process
+            with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+                futures = [executor.submit(_process_one, cm_label_path, cm_label_file_name, planet_boxes_path)
+                           for cm_label_path, cm_label_file_name in cm_label_files]
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    cm_reshape, I1_patches_reshape, I2_patches_reshape, local_counts = future.result()
+                    counts += local_counts
+                    self.labels.append(torch.from_numpy(cm_reshape))
+                    self.imgs_1.append(torch.from_numpy(I1_patches_reshape))
+                    self.imgs_2.append(torch.from_numpy(I2_patches_reshape))
+            self.labels = torch.cat(self.labels, dim=0)
+            self.weights = (1.0 / counts).tolist()
         else:
-            for planet_test_folder_name in tqdm(os.listdir(self.label_path)):
-                # load and store each image
-                one_lat_test_path = os.path.join(config['dataset']['planet_test_boxes_path'], planet_test_folder_name)
-                if not os.path.isfile(one_lat_test_path):
-                    for one_location_test_folder_name in os.listdir(one_lat_test_path):
-                        test_folder_path = os.path.join(one_lat_test_path, one_location_test_folder_name, 'L3H-SR')
-                        test_file_name_filtered = [test_file_name for test_file_name in os.listdir(test_folder_path) if
-                                                   '-01.tif' in test_file_name]
-                        test_file_name_filtered_and_sort = natsort.natsorted(test_file_name_filtered)
-                        for idx, test_file_name in enumerate(test_file_name_filtered_and_sort):
-                            if idx != 23:
-                                original_image_path = os.path.join(test_folder_path, test_file_name)
-                                changed_image_path = os.path.join(test_folder_path,
-                                                                  test_file_name_filtered_and_sort[idx + 1])
-                                I1, I2 = io.imread(original_image_path), io.imread(changed_image_path)
-                                I1 = (I1 - I1.mean()) / I1.std()
-                                I2 = (I2 - I2.mean()) / I2.std()
-                                I1_patches = cut_image_strided(I1.transpose(2, 0, 1), (256, 256))
-                                I1_patches_reshape = I1_patches.reshape(I1_patches.shape[0] * I1_patches.shape[1],
-                                                                        *I1_patches.shape[2:])
-                                for num_patch in range(0, I1_patches_reshape.shape[0]):
-                                    self.imgs_1.append(torch.from_numpy(I1_patches_reshape[num_patch]))
-
-                                I2_resized = cut_image_strided(I2.transpose(2, 0, 1), (256, 256))
-                                I2_patches_reshape = I2_resized.reshape(I2_resized.shape[0] * I2_resized.shape[1],
-                                                                        *I2_resized.shape[2:])
-                                for num_patch in range(0, I2_patches_reshape.shape[0]):
-                                    self.imgs_2.append(torch.from_numpy(I2_patches_reshape[num_patch]))
+            for location_pairs in tqdm(test_image_pairs):
+                # load and store each image, each changed image is the original image of the next pair, it is only
+                # read once
+                patches_cache = {}
+                for original_image_path, changed_image_path in location_pairs:
+                    self.imgs_1.append(self._load_raw_patches(original_image_path, patches_cache))
+                    self.imgs_2.append(self._load_raw_patches(changed_image_path, patches_cache))
+
+        # all patches are kept in one contiguous tensor of shape (n_patches, bands, 256, 256)
+        self.imgs_1 = torch.cat(self.imgs_1, dim=0)
+        self.imgs_2 = torch.cat(self.imgs_2, dim=0)
+
+        if cache_dir is not None:
+            self._save_cache(cache_dir, cache_sources)
+
+    @staticmethod
+    def _load_raw_patches(image_path, patches_cache):
+        """
+        Read a Planet image as raw patches, reusing the patches already read for the same path
+        :param image_path: Planet image file path
+        :param patches_cache: dict from image path to patches tensor
+        :return: tensor of shape (n_patches, bands, 256, 256)
+        """
+        if image_path not in patches_cache:
+            patches_cache[image_path] = torch.from_numpy(read_patches(image_path))
+        return patches_cache[image_path]
+
+    def _save_cache(self, cache_dir, cache_sources):
+        """
+        Write the loaded patches to memory-mapped files so that next runs can skip decoding
+        :param cache_dir: cache folder path
+        :param cache_sources: dataset folders and files fingerprint the patches were computed from
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        meta_path = os.path.join(cache_dir, 'meta.json')
+        if os.path.isfile(meta_path):
+            # a stale cache must not be picked up while its files are overwritten
+            os.remove(meta_path)
+        tensors = {'imgs_1': self.imgs_1, 'imgs_2': self.imgs_2}
+        if self.train:
+            tensors['labels'] = self.labels
+        meta = {'version': CACHE_VERSION, 'sources': cache_sources}
+        for name, tensor in tensors.items():
+            array = tensor.numpy()
+            cached = np.memmap(os.path.join(cache_dir, name + '.bin'), dtype=array.dtype, mode='w+',
+                               shape=array.shape)
+            cached[:] = array
+            cached.flush()
+            meta[name] = {'shape': list(array.shape), 'dtype': array.dtype.str}
+        if self.train:
+            meta['weights'] = self.weights
+        # meta.json is written last, a partially written cache is never picked up
+        with open(meta_path, 'w') as stream:
+            json.dump(meta, stream)
+
+    def _load_cache(self, cache_dir, cache_sources):
+        """
+        Open the patches written by _save_cache as memory-mapped tensors
+        :param cache_dir: cache folder path
+        :param cache_sources: dataset folders and files fingerprint the patches must have been computed from
+        :return: False when there is no cache or it was written from other files or by another cache version
+        """
+        meta_path = os.path.join(cache_dir, 'meta.json')
+        if not os.path.isfile(meta_path):
+            return False
+        with open(meta_path, 'r') as stream:
+            meta = json.load(stream)
+        if meta.get('version') != CACHE_VERSION or meta.get('sources') != cache_sources:
+            print("The patch cache in {} is outdated, it is rebuilt".format(cache_dir))
+            return False
+        for name in ('imgs_1', 'imgs_2', 'labels'):
+            if name in meta:
+                cached = np.memmap(os.path.join(cache_dir, name + '.bin'), dtype=np.dtype(meta[name]['dtype']),
+                                   mode='c', shape=tuple(meta[name]['shape']))
+                setattr(self, name, torch.from_numpy(cached))
+        if 'weights' in meta:
+            self.weights = meta['weights']
+        return True
 
     def get_img(self, im_name):
         return self.imgs_1[im_name], self.imgs_2[im_name], self.labels[im_name]
@@ -208,7 +440,7 @@ class ChangeDetectionDataset(Dataset):
         return len(self.imgs_1)
 
     def __getitem__(self, idx):
-
+        # idx may also be a list of indices, the whole batch is then gathered at once
         if self.train:
             sample = {'I1': self.imgs_1[idx], 'I2': self.imgs_2[idx], 'label': self.labels[idx]}
         else:
@@ -220,35 +452,20 @@ class ChangeDetectionDataset(Dataset):
         return sample
 
     def rgb_to_onehot(self, rgb_arr):
-        """Convert rgb array to one hot encoded mask"""
-        num_classes = len(self.color_label_dict)
-        shape = rgb_arr.shape[:2] + (num_classes,)
-        arr = np.zeros(shape, dtype=np.int8)
-        for i, cls in enumerate(self.color_label_dict):
-            arr[:, :, i] = np.all(rgb_arr.reshape((-1, 3)) == self.color_label_dict[i], axis=1).reshape(shape[:2])
-        return arr
+        """Convert rgb array to one hot encoded mask, built from the class ids of rgb_to_indices"""
+        class_ids = np.arange(len(PALETTE), dtype=np.uint8)
+        return (rgb_to_indices(rgb_arr)[..., np.newaxis] == class_ids).view(np.int8)
 
     def inverse_ohe(self, ohe_labels):
         """converts one-hot encoded mask to the multiclass mask"""
-        inverse_ohe_img = np.zeros(ohe_labels.shape[:2] + (1,))
-        for ch in range(ohe_labels.shape[-1]):
-            ys, xs = np.where(ohe_labels[..., ch])
-            inverse_ohe_img[ys, xs] = ch
-        inverse_ohe_img = np.repeat(inverse_ohe_img, 3, axis=2).astype(int)
-        return inverse_ohe_img
-
-    def compute_for_INS_weights(self, cm_indices_np, n_pix, n_pix0, n_pix1, n_pix2, n_pix3, n_pix4, n_pix5, n_pix6,
-                                n_pix7):
+        idx = ohe_labels.argmax(axis=-1).astype(np.int32, copy=False)
+        return np.broadcast_to(idx[..., None], idx.shape + (3,)).copy()
+
+    @staticmethod
+    def compute_for_INS_weights(cm_indices_np, counts):
         """
         Compute the pixel number of each class to apply the Inverse of Number of Samples to handle classes imbalances
+        :param cm_indices_np: multiclass mask
+        :param counts: per class pixel counts, updated in place
         """
-        n_pix += np.prod(cm_indices_np.shape)
-        n_pix0 += np.count_nonzero(cm_indices_np == 0)
-        n_pix1 += np.count_nonzero(cm_indices_np == 1)
-        n_pix2 += np.count_nonzero(cm_indices_np == 2)
-        n_pix3 += np.count_nonzero(cm_indices_np == 3)
-        n_pix4 += np.count_nonzero(cm_indices_np == 4)
-        n_pix5 += np.count_nonzero(cm_indices_np == 5)
-        n_pix6 += np.count_nonzero(cm_indices_np == 6)
-        n_pix7 += np.count_nonzero(cm_indices_np == 7)
-        return n_pix0, n_pix1, n_pix2, n_pix3, n_pix4, n_pix5, n_pix6, n_pix7
+        counts += np.bincount(cm_indices_np.ravel(), minlength=len(counts))
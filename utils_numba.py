@@ -0,0 +1,19 @@
+# Numba kernels
+
+from numba import njit
+
+
+# serial on purpose, ChangeDetectionDataset already runs one call per file in a process pool and a numba thread
+# pool inherited through fork deadlocks the workers
+@njit(fastmath=True, cache=True)
+def rgb_to_idx(rgb, out):
+    """
+    Convert rgb array to the multiclass mask in a single pass
+    Every PALETTE colour is in {0, 128}^3 and its class id is the 3 bit number (b, g, r) of its channels
+    :param rgb: uint8 numpy array of shape (size_y, size_x, 3)
+    :param out: numpy array of shape (size_y, size_x) filled with labels value between 0 and 7
+    """
+    size_y, size_x, _ = rgb.shape
+    for y in range(size_y):
+        for x in range(size_x):
+            out[y, x] = (rgb[y, x, 2] // 128) * 4 + (rgb[y, x, 1] // 128) * 2 + rgb[y, x, 0] // 128